@@ -4,17 +4,30 @@ __author__ = "Srihari Humbarwadi"
 
 import concurrent
 import concurrent.futures
+import functools
+import itertools
+import mimetypes
+import multiprocessing
 import os
+import queue
+import random
+import shutil
+import socket
 import threading
 import time
 from io import BytesIO
+from urllib.parse import urlsplit
 
-import numpy as np
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from absl import app, flags, logging
 from PIL import Image
-from skimage.io import imsave
+from pyarrow import csv as pa_csv
+
+try:
+    from image_downloader import codec
+except ImportError:  # run as a script, `image_downloader/` is on sys.path
+    import codec
 
 flags.DEFINE_integer(
     name='max_workers',
@@ -56,26 +69,44 @@ flags.DEFINE_boolean(
 flags.DEFINE_integer(
     name='sleep_time',
     default=1,
-    help='Number of seconds to wait before attempting to download'
-    '(for each worker)')
+    help='Number of seconds to wait before the first attempt to download, the '
+    'wait doubles on every retry up to `max_backoff_time` (for each worker)')
 
 flags.DEFINE_integer(
     name='min_sleep_time',
     default=0,
-    help='Minimum number of seconds to wait before attempting to download'
-    '(for each worker), used only if `random_sleep_time=True`')
+    help='Minimum number of seconds to wait before the first attempt to '
+    'download (for each worker), used only if `random_sleep_time=True`')
 
 flags.DEFINE_integer(
     name='max_sleep_time',
     default=5,
-    help='Maximum number of seconds to wait before attempting to download'
-    '(for each worker), used only if `random_sleep_time=True`')
+    help='Maximum number of seconds to wait before the first attempt to '
+    'download (for each worker), used only if `random_sleep_time=True`')
+
+flags.DEFINE_integer(
+    name='max_backoff_time',
+    default=8,
+    help='Maximum number of seconds to wait between attempts, caps the wait '
+    'that doubles on every retry')
 
 flags.DEFINE_integer(
     name='max_attempts',
     default=5,
-    help='Maximum number of attempts that workers will try before a url is marked as'
-    '"failed"')
+    help='Maximum number of attempts that workers will try before a url is marked '
+    'as "failed". The wait before each retry doubles, up to `max_backoff_time`')
+
+flags.DEFINE_float(
+    name='connect_timeout',
+    default=5.0,
+    help='Number of seconds to wait for a connection to be established before '
+    'an attempt is marked as failed')
+
+flags.DEFINE_float(
+    name='read_timeout',
+    default=30.0,
+    help='Number of seconds to wait for the server to send data before an '
+    'attempt is marked as failed')
 
 flags.DEFINE_boolean(
     name='random_sleep_time',
@@ -83,6 +114,36 @@ flags.DEFINE_boolean(
     help='Randomize wait time, if set to true `sleep_time` will be overided with a'
     'random between `min_sleep_time` and `max_sleep_time`')
 
+flags.DEFINE_boolean(
+    name='reencode',
+    default=False,
+    help='Decode and re-encode images before saving, by default the downloaded '
+    'bytes are written to disk as-is')
+
+flags.DEFINE_integer(
+    name='max_side',
+    default=0,
+    help='Downscale images so that their longest side is at most `max_side` '
+    'pixels, used only if set to a non-zero integer. Implies `reencode=True`')
+
+flags.DEFINE_boolean(
+    name='validate',
+    default=False,
+    help='Verify that downloaded bytes are a valid image before saving. Used only '
+    'if `reencode=False`')
+
+flags.DEFINE_integer(
+    name='write_threads',
+    default=0,
+    help='Number of dedicated threads writing images to disk. If set to 0, '
+    'workers stream images to disk themselves. Used only if `reencode=False`')
+
+flags.DEFINE_integer(
+    name='queue_size',
+    default=1000,
+    help='Maximum number of downloaded images waiting to be written to disk. '
+    'Used only if `write_threads` is set to a non-zero integer')
+
 flags.DEFINE_boolean(
     name='debug',
     default=False,
@@ -90,107 +151,255 @@ flags.DEFINE_boolean(
 
 FLAGS = flags.FLAGS
 
-_COUNT = 0
-_count_lock = threading.Lock()
+_COUNTER = itertools.count(1)
+_thread_local = threading.local()
+_io_throttled = threading.Event()
+
+_CHUNK_SIZE = 64 * 1024
+
+_DNS_CACHE_SIZE = 4096
+
+_HEADERS = {
+    'user-agent': '''Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Mobile Safari/537.36'''  # pylint: disable=line-too-long
+}
+
+_SESSION = requests.Session()
+_SESSION.headers.update(_HEADERS)
+
+
+def _log_prefix():
+    """Returns the `[Thread: <name>]` log prefix, cached per thread"""
+    prefix = getattr(_thread_local, 'prefix', None)
+    if prefix is None:
+        prefix = f'[Thread: {threading.current_thread().name}]'
+        _thread_local.prefix = prefix
+    return prefix
+
+
+def _install_dns_cache():
+    """Memoizes `socket.getaddrinfo` so that each host is resolved only once"""
+    if not hasattr(socket.getaddrinfo, 'cache_info'):
+        socket.getaddrinfo = functools.lru_cache(maxsize=_DNS_CACHE_SIZE)(
+            socket.getaddrinfo)
+
+
+def _mount_session_adapters(pool_size):
+    """Shares one pooled adapter across all workers so connections are reused"""
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          pool_block=True,
+                          max_retries=0)
+    _SESSION.mount('http://', adapter)
+    _SESSION.mount('https://', adapter)
+
 
 def _read_urls_from_text_file(path):
     with open(path, 'r') as _fp:
-        urls = [line.strip() for line in _fp.readlines()]
+        urls = [line.strip() for line in _fp]
     return urls
 
 
 def _read_urls_from_csv_file(path, column_name):
-    urls = pd.read_csv(path)[column_name].values.tolist()
+    convert_options = pa_csv.ConvertOptions(include_columns=[column_name])
+    urls = pa_csv.read_csv(
+        path, convert_options=convert_options)[column_name].to_pylist()
     return urls
 
 
+def _list_downloaded_files(folder):
+    """Returns the names (with and without extension) of files in `folder`"""
+    downloaded = set()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith('.part'):
+                continue
+            downloaded.add(entry.name)
+            downloaded.add(os.path.splitext(entry.name)[0])
+    return frozenset(downloaded)
+
+
+def _url_host(url):
+    """Returns the host part of `url`, or '' if the url cannot be parsed"""
+    try:
+        return urlsplit(url).netloc
+    except ValueError:
+        return ''
+
+
 def _dump_failed_urls(urls, path='failed_urls.txt'):
     with open(path, 'w') as _fp:
         for url in urls:
             _fp.writelines(url + '\n')
 
 
-def download_image_from_url(  # pylint: disable=too-many-arguments
+def _add_extension(file_save_path, content_type):
+    """Appends an extension inferred from an image `content_type` if the path
+    has none"""
+    if os.path.splitext(file_save_path)[1] or not content_type:
+        return file_save_path
+    mime_type = content_type.split(';')[0].strip().lower()
+    if not mime_type.startswith('image/'):
+        return file_save_path
+    extension = mimetypes.guess_extension(mime_type)
+    return file_save_path + (extension or '')
+
+
+def _stream_to_file(fileobj, file_save_path, validate=False):
+    """Streams `fileobj` to disk, optionally verifying the image first"""
+    with codec.partial_file(file_save_path) as partial_path:
+        with open(partial_path, 'wb') as _fp:
+            shutil.copyfileobj(fileobj, _fp, length=_CHUNK_SIZE)
+        if validate:
+            with Image.open(partial_path) as image:
+                image.verify()
+
+
+def _log_saved(file_name, total):
+    """Counts a completed image and logs that it was saved"""
+    completed = next(_COUNTER)
+    logging.info(
+        f'{_log_prefix()} [Completed: {completed}/{total}] Saved image: '
+        f'{file_name[:10]}... to disk ')
+
+
+def _disk_writer(write_queue, failed_urls, failed_lock, total):
+    """Writes `(url, path, bytes)` items from `write_queue` until a `None`
+    sentinel, recording urls that could not be written in `failed_urls`"""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        url, file_save_path, content = item
+        try:
+            _stream_to_file(BytesIO(content), file_save_path)
+        except Exception as error:  # pylint: disable=broad-except
+            logging.error(f'{_log_prefix()} Failed writing {file_save_path}: '
+                          f'{error}')
+            with failed_lock:
+                failed_urls.append(url)
+            continue
+        _log_saved(os.path.basename(url), total)
+
+
+def _enqueue_write(write_queue, url, file_save_path, content):
+    """Hands downloaded bytes to the writer threads, blocking when they lag"""
+    if write_queue.full() and not _io_throttled.is_set():
+        _io_throttled.set()
+        logging.warning('Throttling due to I/O bottleneck, consider raising '
+                        '`write_threads` or `queue_size`')
+    write_queue.put((url, file_save_path, content))
+
+
+def _backoff_time(attempt, sleep_time, min_sleep_time, max_sleep_time,  # pylint: disable=too-many-arguments
+                  random_sleep_time, max_backoff_time):
+    """Returns the number of seconds to wait before the given attempt"""
+    if random_sleep_time:
+        sleep_time = random.uniform(min_sleep_time, max_sleep_time)
+    return min(sleep_time * 2**attempt, max_backoff_time)
+
+
+def _download(url, file_save_path, reencode, validate, decoder_pool,  # pylint: disable=too-many-arguments
+              write_queue, max_side, timeout):
+    """Downloads a single url and saves it to `file_save_path`, returns `True`
+    if writing the image was handed off to the writer threads"""
+    with _SESSION.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        file_save_path = _add_extension(
+            file_save_path, response.headers.get('content-type'))
+        response.raw.decode_content = True
+        if not reencode and write_queue is None:
+            _stream_to_file(response.raw, file_save_path, validate=validate)
+            return False
+        content = response.raw.read()
+    if not reencode:
+        if validate:
+            Image.open(BytesIO(content)).verify()
+        _enqueue_write(write_queue, url, file_save_path, content)
+        return True
+    if decoder_pool is None:
+        codec.decode_and_save(content, file_save_path, max_side=max_side)
+    else:
+        decoder_pool.submit(codec.decode_and_save, content, file_save_path,
+                            max_side).result()
+    return False
+
+
+def download_image_from_url(  # pylint: disable=too-many-arguments, too-many-locals
         url,
         output_folder,
         sleep_time=2,
         min_sleep_time=0,
         max_sleep_time=5,
         random_sleep_time=True,
-        num_attempts=0,
         max_attempts=3,
-        total=0):
+        max_backoff_time=8,
+        total=0,
+        reencode=False,
+        validate=False,
+        decoder_pool=None,
+        write_queue=None,
+        max_side=0,
+        timeout=None):
 
     """Downloads and saves images from a urls"""
-    global _COUNT  # pylint: disable=global-statement
-    def _imread(url):
-        """Downloads an images and returns it as an numpy array"""
-        headers = {
-            'user-agent': '''Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Mobile Safari/537.36'''  # pylint: disable=line-too-long
-        }
-        response = requests.get(url, headers=headers)
-        image = Image.open(BytesIO(bytes(response.content)))
-        return np.array(image, dtype=np.uint8)
-
-    current_thread_id = threading.current_thread().name
+    prefix = _log_prefix()
     file_name = os.path.basename(url)
     file_save_path = os.path.join(output_folder, file_name)
 
-    if os.path.exists(file_save_path):
-        with _count_lock:
-            _COUNT += 1
-        logging.warning('[Thread: {}] Image with name: {} already downloaded'.
-                        format(current_thread_id, file_name))
-        return 1
+    for attempt in range(max_attempts):
+        wait_time = _backoff_time(attempt,
+                                  sleep_time=sleep_time,
+                                  min_sleep_time=min_sleep_time,
+                                  max_sleep_time=max_sleep_time,
+                                  random_sleep_time=random_sleep_time,
+                                  max_backoff_time=max_backoff_time)
+        if wait_time:
+            if logging.level_debug():
+                logging.debug(
+                    f'{prefix} Sleeping for {wait_time:.2f} secs on attempt '
+                    f'{attempt}')
+            time.sleep(wait_time)
+
+        try:
+            queued = _download(url,
+                               file_save_path=file_save_path,
+                               reencode=reencode,
+                               validate=validate,
+                               decoder_pool=decoder_pool,
+                               write_queue=write_queue,
+                               max_side=max_side,
+                               timeout=timeout)
+        except Exception as _:  # pylint: disable=broad-except
+            logging.info(
+                f'{prefix}  [attempt: {attempt + 1}/{max_attempts}] Failed '
+                f'downloading image: {file_name} ')
+            continue
 
-    if num_attempts == max_attempts:
         logging.info(
-            '[Thread: {}] Cannot download image: {} after {} attempts.'.
-            format(current_thread_id, file_name, num_attempts))
-        return -1
-
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder, exist_ok=True)
-        logging.info('Created output folder at {}'.format(output_folder))
-
-    if random_sleep_time:
-        sleep_time = np.random.randint(min_sleep_time, max_sleep_time)
+            f'{prefix} [attempt: {attempt + 1}/{max_attempts}] Successfully '
+            f'downloaded image: {file_name[:10]}...')
+        if not queued:
+            _log_saved(file_name, total)
+        return 1
 
-    if sleep_time:
-        logging.debug('[Thread: {}] Sleeping for {} secs on attempt {}'.format(
-            current_thread_id, sleep_time, num_attempts))
-        time.sleep(sleep_time)
+    logging.info(
+        f'{prefix} Cannot download image: {file_name} after {max_attempts} '
+        'attempts.')
+    return -1
 
-    try:
-        num_attempts += 1
-        image = _imread(url)
-        logging.info(
-            '[Thread: {}] [attempt: {}/{}] Successfully downloaded image: '
-            '{}...' .format(current_thread_id, num_attempts,
-                max_attempts, file_name[:10]))
 
-    except Exception as _:  # pylint: disable=broad-except
-        logging.info(
-            '[Thread: {}]  [attempt: {}/{}] Failed downloading image: {} '
-            .format(current_thread_id, num_attempts, max_attempts, file_name))
-        return download_image_from_url(url=url,
-                                       output_folder=output_folder,
-                                       min_sleep_time=min_sleep_time,
-                                       max_sleep_time=max_sleep_time,
-                                       random_sleep_time=random_sleep_time,
-                                       num_attempts=num_attempts,
-                                       max_attempts=max_attempts)
-    imsave(file_save_path, image, check_contrast=False)
-    with _count_lock:
-        _COUNT += 1
-        logging.info(
-            '[Thread: {}] [Completed: {}/{}] Saved image: {}... to disk '
-            .format(current_thread_id, _COUNT, total, file_name[:10]))
-
-    return 1
+def _download_worker(url_queue, failed_urls, failed_lock, **kwargs):
+    """Downloads urls from `url_queue` until a `None` sentinel is received"""
+    while True:
+        url = url_queue.get()
+        if url is None:
+            return
+        if download_image_from_url(url, **kwargs) == -1:
+            with failed_lock:
+                failed_urls.append(url)
 
 
-def main(args):  # pylint: disable=missing-function-docstring, too-many-branches
+def main(args):  # pylint: disable=missing-function-docstring, too-many-branches, too-many-locals, too-many-statements
 
     del args
 
@@ -200,6 +409,9 @@ def main(args):  # pylint: disable=missing-function-docstring, too-many-branches
     else:
         logging.set_verbosity(logging.INFO)
 
+    _install_dns_cache()
+    _mount_session_adapters(pool_size=FLAGS.max_workers)
+
     if not FLAGS.input_text_file == '':
         urls = _read_urls_from_text_file(path=FLAGS.input_text_file)
 
@@ -213,56 +425,102 @@ def main(args):  # pylint: disable=missing-function-docstring, too-many-branches
 
     if FLAGS.max_images > 0:
         if FLAGS.shuffle_urls:
-            np.random.shuffle(urls)
+            random.shuffle(urls)
         urls = urls[:FLAGS.max_images]
 
-    total = len(urls)
-    logging.warning('Downloading {} urls'.format(total))
+    if not os.path.exists(FLAGS.output_folder):
+        os.makedirs(FLAGS.output_folder, exist_ok=True)
+        logging.info(f'Created output folder at {FLAGS.output_folder}')
 
-    status = {}
-    future_to_url = {}
+    downloaded = _list_downloaded_files(FLAGS.output_folder)
+    num_urls = len(urls)
+    urls = [url for url in urls if os.path.basename(url) not in downloaded]
+    if len(urls) < num_urls:
+        logging.warning(
+            f'Skipping {num_urls - len(urls)} already downloaded urls')
 
+    # Keep urls from the same host together so pooled connections are reused,
+    # sort is stable so any shuffled order within a host is preserved
+    urls.sort(key=_url_host)
 
-    if FLAGS.random_sleep_time:
-        timeout = (FLAGS.max_sleep_time * FLAGS.max_attempts)
-    else:
-        timeout = (FLAGS.sleep_time * FLAGS.max_attempts)
-    logging.warning('Setting timeout={} seconds'.format(timeout))
+    total = len(urls)
+    logging.warning(f'Downloading {total} urls')
+
+    reencode = FLAGS.reencode or FLAGS.max_side > 0
+    decoder_pool = None
+    if reencode:
+        # Decoders are started lazily from download threads, forking a
+        # multi-threaded process there can deadlock on locks held by others
+        decoder_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn'))
+
+    failed_urls = []
+    failed_lock = threading.Lock()
+
+    write_queue = None
+    writers = []
+    if FLAGS.write_threads > 0 and not reencode:
+        write_queue = queue.Queue(maxsize=FLAGS.queue_size)
+        writers = [
+            threading.Thread(target=_disk_writer,
+                             name=f'writer_{i}',
+                             args=(write_queue, failed_urls, failed_lock,
+                                   total),
+                             daemon=True) for i in range(FLAGS.write_threads)
+        ]
+
+    url_queue = queue.Queue(maxsize=FLAGS.max_workers * 4)
+    workers = [
+        threading.Thread(
+            target=_download_worker,
+            name=f'worker_{i}',
+            args=(url_queue, failed_urls, failed_lock),
+            kwargs={
+                'output_folder': FLAGS.output_folder,
+                'sleep_time': FLAGS.sleep_time,
+                'min_sleep_time': FLAGS.min_sleep_time,
+                'max_sleep_time': FLAGS.max_sleep_time,
+                'random_sleep_time': FLAGS.random_sleep_time,
+                'max_attempts': FLAGS.max_attempts,
+                'max_backoff_time': FLAGS.max_backoff_time,
+                'total': total,
+                'reencode': reencode,
+                'validate': FLAGS.validate,
+                'decoder_pool': decoder_pool,
+                'write_queue': write_queue,
+                'max_side': FLAGS.max_side,
+                'timeout': (FLAGS.connect_timeout, FLAGS.read_timeout)
+            },
+            daemon=True) for i in range(FLAGS.max_workers)
+    ]
 
     tik = time.time()
-    with concurrent.futures.ThreadPoolExecutor(
-            max_workers=FLAGS.max_workers,
-            thread_name_prefix='worker') as executor:
-        for url in urls:
-            future = executor.submit(
-                download_image_from_url,
-                url=url,
-                output_folder=FLAGS.output_folder,
-                sleep_time=FLAGS.sleep_time,
-                min_sleep_time=FLAGS.min_sleep_time,
-                max_sleep_time=FLAGS.max_sleep_time,
-                random_sleep_time=FLAGS.random_sleep_time,
-                num_attempts=0,
-                max_attempts=FLAGS.max_attempts,
-                total=total)
-            future_to_url[future] = url
-
-        for future in concurrent.futures.as_completed(future_to_url):
-            try:
-                status[future_to_url[future]] = future.result(timeout=timeout)
-            except concurrent.futures.TimeoutError:
-                status[future_to_url[future]] = -1
+    for thread in writers + workers:
+        thread.start()
+    for url in urls:
+        url_queue.put(url)
+    for _ in workers:
+        url_queue.put(None)
+    for worker in workers:
+        worker.join()
+    for _ in writers:
+        write_queue.put(None)
+    for writer in writers:
+        writer.join()
     tok = time.time()
 
-    failed_urls = [url for url, result in status.items() if result == -1]
+    if decoder_pool is not None:
+        decoder_pool.shutdown()
+
     if failed_urls:
         _dump_failed_urls(failed_urls)
         logging.warning(
-            'Failed downloading {} urls. Dumping failed urls at `failed_urls.txt`'.
-            format(len(failed_urls)))
+            f'Failed downloading {len(failed_urls)} urls. Dumping failed urls '
+            'at `failed_urls.txt`')
     else:
-        logging.info('Successfully downloading {} urls in {:.2f} secs'.format(
-            len(urls), tok - tik))
+        logging.info(
+            f'Successfully downloading {len(urls)} urls in {tok - tik:.2f} secs')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,41 @@
+"""codec.py: Decode, downscale and save images, importable by decoder processes."""
+
+__author__ = "Srihari Humbarwadi"
+
+import contextlib
+import os
+from io import BytesIO
+
+from PIL import Image
+
+
+@contextlib.contextmanager
+def partial_file(file_save_path):
+    """Yields a `.part` path that replaces `file_save_path` only on success"""
+    partial_path = file_save_path + '.part'
+    try:
+        yield partial_path
+        os.replace(partial_path, file_save_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def decode_and_save(content, file_save_path, max_side=0):
+    """Decodes raw image bytes, optionally downscales and writes them to disk"""
+    image = Image.open(BytesIO(content))
+    source_format = image.format
+    if max_side > 0:
+        if image.format == 'JPEG':
+            # Lets libjpeg decode at a reduced DCT scale instead of full size
+            image.draft('RGB', (max_side, max_side))
+        image.thumbnail((max_side, max_side))
+    extension = os.path.splitext(file_save_path)[1].lower()
+    save_format = Image.registered_extensions().get(extension, source_format)
+    save_kwargs = {}
+    if save_format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        save_kwargs = {'quality': 90, 'optimize': False}
+    with partial_file(file_save_path) as partial_path:
+        image.save(partial_path, format=save_format, **save_kwargs)